@@ -1,49 +1,203 @@
 import streamlit as st
-from langchain_community.llms import OpenAI
-from langchain.chains import LLMChain
-from langchain.prompts import PromptTemplate, ChatPromptTemplate, MessagesPlaceholder
+from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
+import asyncio
 import os
+import re
+from typing import Literal
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI  # Updated import for ChatOpenAI
 from langchain.agents import AgentExecutor, create_openai_tools_agent
-from langchain_core.messages import HumanMessage
-from langchain.tools import Tool
+from langchain.agents.agent import RunnableMultiActionAgent
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain.tools import StructuredTool, Tool
+from langchain_core.globals import set_llm_cache
+from langchain_core.utils.json import parse_partial_json
+from langchain_community.cache import SQLiteCache
 from functools import partial
+from pydantic import BaseModel, Field
 
-from utils import load_data, get_dataframe_shape, get_column_statistics, detect_outliers_iqr, run_pandasql_query
+from utils import (load_columns, load_data, get_columns_str, get_dataframe_shape, get_column_statistics,
+                   detect_outliers_iqr, run_pandasql_query)
 
 # Load environment variables
 load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Print intermediate agent steps only when debugging, e.g. LANGCHAIN_VERBOSE=1
+AGENT_VERBOSE = os.getenv("LANGCHAIN_VERBOSE", "").lower() in ("1", "true", "yes")
+
+# Cache LLM responses on disk so repeated questions skip the OpenAI round-trip
+set_llm_cache(SQLiteCache(database_path=".langchain_cache.db"))
+
+# SQL the model wrapped in a Markdown code block, e.g. ```sql ... ```
+SQL_FENCE_RE = re.compile(r"\s*```(?:sql)?\s*(.*?)\s*```\s*", re.IGNORECASE | re.DOTALL)
+
+# Upper bound on agent runs in flight when several questions are asked at once
+MAX_CONCURRENT_QUESTIONS = 8
+
+# Trivial questions answered from the DataFrame itself, without calling the LLM
+_TABLE_NOUN = r"(?: (?:in|of) (?:the|this|my) (?:data|dataset|table|dataframe|file))?"
+SHAPE_RE = re.compile(
+    r"\s*(?:how many (?:rows|columns)(?: and (?:rows|columns))?(?: are there)?" + _TABLE_NOUN
+    + r"|(?:what is |what's )?(?:the )?(?:shape|dimensions?)" + _TABLE_NOUN + r")\s*[?.!]*\s*",
+    re.IGNORECASE)
+LIST_RE = re.compile(
+    r"\s*(?:(?:please )?(?:list|show)(?: me)?|what are)(?: all)?(?: of)?(?: the)? (?:columns|column names)"
+    + _TABLE_NOUN + r"\s*[?.!]*\s*",
+    re.IGNORECASE)
+
+
+def answer_locally(question, df):
+    """Returns the answer to a shape or column-list question, or None if the LLM is needed."""
+    if SHAPE_RE.fullmatch(question):
+        return get_dataframe_shape(df)
+    if LIST_RE.fullmatch(question):
+        return df.columns.tolist()
+    return None
+
+
+class Decision(BaseModel):
+    """Final answer to the user's question."""
+
+    action: Literal["sql", "warning", "message"] = Field(
+        description="'sql' for a SQL query to run on df, 'warning' when the question cannot be answered "
+                    "as asked, 'message' for any other answer.")
+    payload: str = Field(description="The SQL query, or the text to show the user.")
+
+
+class TextStreamHandler(BaseCallbackHandler):
+    """Streams the model's answer into a Streamlit placeholder as tokens arrive.
+
+    Answers arrive as a ``respond`` tool call, so the payload of 'message' decisions is
+    read from the partial tool-call arguments; plain-text replies are streamed as-is.
+    SQL queries and warnings are only rendered once the full decision is known.
+    """
+
+    # Run on the event loop thread: Streamlit elements can only be updated from the script thread
+    run_inline = True
+
+    def __init__(self, placeholder):
+        self.placeholder = placeholder
+        self.run_id = None
+        self.text = ""
+        self.tool_calls = {}
+
+    def on_llm_new_token(self, token, *, run_id, chunk=None, **kwargs):
+        if run_id != self.run_id:
+            self.run_id, self.text, self.tool_calls = run_id, "", {}
+        self.text += token
+        message = getattr(chunk, "message", None)
+        for tool_call in getattr(message, "tool_call_chunks", None) or []:
+            call = self.tool_calls.setdefault(tool_call.get("index"), {"name": "", "args": ""})
+            call["name"] += tool_call.get("name") or ""
+            call["args"] += tool_call.get("args") or ""
+
+        shown = self.text
+        for call in self.tool_calls.values():
+            if call["name"] == "respond":
+                decision = parse_partial_json(call["args"]) or {}
+                if decision.get("action") == "message":
+                    shown = decision.get("payload") or ""
+        if shown.strip():
+            self.placeholder.markdown(shown + "▌")
+
 
 # Define Langchain Tools for function calling
-tools = [
-    Tool(
-        name="get_dataframe_shape",
-        func=get_dataframe_shape,
-        description=(
-            "Use ONLY if the user explicitly asks for the number of rows and columns "
-            "and it cannot be answered with SQL. Otherwise, always use SQL."
-        )
-    ),
-    Tool(
-        name="get_column_statistics",
-        func=get_column_statistics,
-        description=(
-            "Use ONLY if the question is about advanced statistics that cannot be expressed in SQL. "
-            "For basic stats (count, nulls, min, max, mean, distinct, variance, stddev, etc.), "
-            "always respond with a SQL query."
-        )
-    ),
-    Tool(
-        name="detect_outliers_iqr",
-        func=detect_outliers_iqr,
-        description=(
-            "Detect outliers in a numerical column using the Interquartile Range (IQR) method. "
-            "This cannot be done with SQL, so use this tool ONLY for outlier detection when the column is specified."
-        )
-    )
-]
+def build_tools(df):
+    """Returns the tools available to the agent, with the Python tools bound to the given DataFrame.
+
+    Python tool results go back to the model, which summarises them; ``respond``
+    returns directly, handing back the model's Decision as the final answer.
+    """
+    return [
+        Tool(name="get_dataframe_shape", func=partial(get_dataframe_shape, df),
+             description="Get the number of rows and columns in the DataFrame. Input is ignored."),
+        Tool(name="get_column_statistics", func=partial(get_column_statistics, df),
+             description="Get descriptive statistics for a specified column."),
+        Tool(name="detect_outliers_iqr", func=partial(detect_outliers_iqr, df),
+             description="Detect outliers in a numerical column using the Interquartile Range (IQR) method."),
+        StructuredTool.from_function(func=Decision, name="respond", args_schema=Decision, return_direct=True,
+                                     description="Give the final answer to the user."),
+    ]
+
+
+# System prompt for the agent; {columns} is filled in per DataFrame
+SYSTEM_PROMPT = """You are a data analysis assistant for the table 'df' with columns: {columns}.
+Always finish by calling `respond`. Python tools may be called first when needed.
+
+- Answer with SQL whenever possible (counts, nulls, min, max, mean, sum, distinct values, variance, stddev, filters): `respond` with action 'sql' and the query as payload. Wrap every column name in backticks.
+- Column statistics: SELECT COUNT(`c`) AS non_null_count, COUNT(*) - COUNT(`c`) AS null_count, MIN(`c`) AS min_value, MAX(`c`) AS max_value, AVG(`c` * 1.0) AS mean_value, SUM(`c`) AS total_value, COUNT(DISTINCT `c`) AS distinct_count FROM df;
+- Rows and columns: SELECT (SELECT COUNT(*) FROM df) AS row_count, (SELECT COUNT(*) FROM pragma_table_info('df')) AS column_count;
+- Categorical (text) columns: never MIN, MAX or AVG. Use the mode or frequency distribution (SELECT `c`, COUNT(*) AS frequency FROM df GROUP BY `c` ORDER BY frequency DESC, with LIMIT 1 for the mode) or COUNT(DISTINCT `c`) AS distinct_count. If numerical statistics are asked for one, respond with a 'warning' asking for a numerical column.
+- Outliers: call detect_outliers_iqr with the column, then `respond` with a 'message' summarising its result. Without a column, respond with a 'warning' asking which column to use.
+- Use the other Python tools only when SQL cannot answer, then summarise their result the same way.
+- Anything else: `respond` with action 'message'.
+"""
+
+BASE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", SYSTEM_PROMPT), MessagesPlaceholder("chat_history", optional=True), ("human", "{input}"),
+    MessagesPlaceholder("agent_scratchpad"),
+])
+
+
+@st.cache_resource(show_spinner=False)
+def build_agent(columns_str):
+    """Builds the tools agent for a table with the given columns, reused across reruns.
+
+    The agent only needs the tool schemas, so it is cached per column list and
+    paired with tools bound to the current DataFrame in an AgentExecutor.
+    """
+    llm = ChatOpenAI(temperature=0, api_key=OPENAI_API_KEY, model="gpt-4o-mini", streaming=True)
+
+    prompt = BASE_PROMPT.partial(columns=columns_str)
+
+    # Invoke rather than stream the runnable: tokens still reach the callbacks,
+    # and ChatOpenAI keeps consulting the LLM cache.
+    return RunnableMultiActionAgent(runnable=create_openai_tools_agent(llm, build_tools(None), prompt),
+                                    stream_runnable=False)
+
+
+def make_agent_executor(df):
+    """Pairs the cached agent for the DataFrame's columns with tools bound to it."""
+    return AgentExecutor(agent=build_agent(get_columns_str(df)), tools=build_tools(df),
+                         verbose=AGENT_VERBOSE)
+
+
+async def answer_question(question, df, answer_placeholder):
+    """Runs the agent on one question with the async OpenAI client, then renders the response."""
+    response = await make_agent_executor(df).ainvoke(
+        {"input": question, "chat_history": []},
+        config={"callbacks": [TextStreamHandler(answer_placeholder)]})
+    render_response(response, df, answer_placeholder)
+
+
+def render_response(response, df, answer_placeholder):
+    """Renders an agent response: warnings, SQL queries (run against df), or plain text."""
+    output = response["output"] if isinstance(response, dict) and "output" in response else response
+    # Python tool results and plain-text replies are shown as messages
+    decision = output if isinstance(output, Decision) else Decision(action="message", payload=str(output))
+
+    # Case 1: The question cannot be answered as asked
+    if decision.action == "warning":
+        answer_placeholder.warning(f"⚠️ {decision.payload}")
+
+    # Case 2: SQL query → run it automatically
+    elif decision.action == "sql":
+        fenced = SQL_FENCE_RE.fullmatch(decision.payload)
+        generated_sql = (fenced.group(1) if fenced else decision.payload).strip()
+        answer_placeholder.info("Generated SQL Query:")
+        st.code(generated_sql, language="sql")
+
+        with st.spinner("🚀 Running SQL query and fetching results..."):
+            result, sql_error_message = run_pandasql_query(generated_sql, df)
+            if sql_error_message:
+                st.error(f"❌ {sql_error_message}")
+            elif result is not None:
+                st.success("✅ Done!")
+                st.dataframe(result)
+
+    # Case 3: Direct tool/text response
+    else:
+        answer_placeholder.write(decision.payload)
 
 
 def main():
@@ -57,8 +211,16 @@ def main():
     df = None
     error_message = None
     if uploaded_file:
-        with st.spinner("⏳ Connecting to database..."):
-            df, error_message = load_data(uploaded_file)
+        file_bytes = uploaded_file.getvalue()
+        # Read the header first so only the selected columns are parsed and kept
+        columns, error_message = load_columns(file_bytes, uploaded_file.name)
+        if columns is not None:
+            options = [column for column in columns if column != 'Unnamed: 0']
+            selected = set(st.sidebar.multiselect("Columns to load", options, default=options))
+            usecols = tuple(position for position, column in enumerate(columns) if column in selected)
+            if usecols:
+                with st.spinner("⏳ Connecting to database..."):
+                    df, error_message = load_data(file_bytes, uploaded_file.name, usecols)
 
     if error_message:
         st.error(f"❌ {error_message}")
@@ -73,150 +235,49 @@ def main():
         st.subheader("💬 Ask a Question about your Data")
 
         user_question = st.text_area(
-            "Enter your question here (e.g., 'How many rows are there?', 'What is the mean of the column X?', 'Are there any outliers in the X column?'):",
+            "Enter your question here, one per line (e.g., 'How many rows are there?', 'What is the mean of the column X?', 'Are there any outliers in the X column?'):",
             height=100)
 
         if st.button("🔍 Get Answer"):
-            if user_question:
-                # Check if OpenAI API key is set
-                if "OPENAI_API_KEY" not in os.environ or not os.environ["OPENAI_API_KEY"]:
-                    st.warning("⚠️ Please set your OpenAI API key in the `.env` file or as an environment variable.")
+            questions = [question.strip() for question in user_question.splitlines() if question.strip()]
+            local_answers = [answer_locally(question, df) for question in questions]
+            needs_llm = any(answer is None for answer in local_answers)
+
+            if not questions:
+                st.warning("⚠️ Please enter a question.")
+            # Check if OpenAI API key is set
+            elif needs_llm and ("OPENAI_API_KEY" not in os.environ or not os.environ["OPENAI_API_KEY"]):
+                st.warning("⚠️ Please set your OpenAI API key in the `.env` file or as an environment variable.")
+            elif len(questions) == 1:
+                st.markdown("### ✨ Analysis Result")
+                if not needs_llm:
+                    st.write(local_answers[0])
                 else:
                     with st.spinner("🧠 Generating response..."):
-                        llm = ChatOpenAI(temperature=0, api_key=OPENAI_API_KEY, model="gpt-4o-mini")
-                        columns_str = ", ".join(df.columns)
-
-                        # Create Langchain Tools with bound functions
-                        python_tools = [
-                            Tool(name="get_dataframe_shape", func=lambda s: get_dataframe_shape(df),
-                                 description="Get the number of rows and columns in the DataFrame. Input is ignored."),
-                            Tool(name="get_column_statistics",
-                                 func=lambda column_name: get_column_statistics(df, column_name),
-                                 description="Get descriptive statistics for a specified column."),
-                            Tool(name="detect_outliers_iqr",
-                                 func=lambda column_name: detect_outliers_iqr(df, column_name),
-                                 description="Detect outliers in a numerical column using the Interquartile Range (IQR) method."),
-                        ]
-
-                        # Agent creation
-                        prompt = ChatPromptTemplate.from_messages([
-                            ("system",
-                             f"""You are a data analysis assistant. You always try to answer using SQL queries first.
-                             The table name is 'df' and it has the following columns: {columns_str}.
-
-
-                             Rules:
-                             1. If the question can be answered with SQL, respond ONLY with a valid SQL query.
-                             2. when generating SQL queries , Wrap each column name in backticks (`) to denote them as delimited identifiers.
-                             2. For descriptive statistics of a column,
-                                you MUST always respond with this SQL pattern (replace 'column_name' with the actual column name):
-
-                                SELECT 
-                                     COUNT(column_name) AS non_null_count,
-                                     COUNT(*) - COUNT(column_name) AS null_count,
-                                     MIN(column_name) AS min_value,
-                                     MAX(column_name) AS max_value,
-                                     AVG(column_name * 1.0) AS mean_value,
-                                     SUM(column_name) AS total_value,
-                                     COUNT(DISTINCT column_name) AS distinct_count
-                                 FROM df;
-
-                             3. For the min you can use :
-                             SELECT MIN(column_name) from df;
-
-                             4. For the max you can use :
-                             SELECT MAX(column_name) from df;
-
-                             5. If the user asks for a single value like mean, or average or sum or count generate an sql query for it.
-
-                             6. For unique values, always use:
-                                SELECT DISTINCT column_name FROM df;
-
-                             7. For the number of rows and columns, always use:
-                                SELECT 
-                                    (SELECT COUNT(*) FROM df) AS row_count,
-                                    (SELECT COUNT(*) FROM pragma_table_info('df')) AS column_count;
-
-
-                             8. If the user asks about outliers:
-                                - If a column name is provided, call the tool `detect_outliers_iqr`.
-                                - If no column is specified, reply exactly with:
-                                  "Please specify a column to detect outliers in."
-
-                             9.  Never use Python tools for min, max, mean, nulls, distinct, or variance/stddev.
-                                These must always be answered with SQL.
-
-                             10. Only call the Python tool `detect_outliers_iqr` when SQL cannot handle the request.
-
-                             Return NOTHING else besides either:
-                             - a SQL query, or
-                             - the exact tool response if needed.
-
-                             11. If the user asks for statistics of a categorical (text/string) column, 
-                             do NOT use MIN, MAX, or AVG. Instead, provide:
-                             - Mode (most frequent value): 
-                                 SELECT `column_name`, COUNT(*) AS frequency 
-                                 FROM df 
-                                 GROUP BY `column_name` 
-                                 ORDER BY frequency DESC 
-                                 LIMIT 1;
-
-                             - Frequency distribution: 
-                                 SELECT `column_name`, COUNT(*) AS frequency 
-                                 FROM df 
-                                 GROUP BY `column_name` 
-                                 ORDER BY frequency DESC;
-
-                             - Number of unique categories: 
-                                 SELECT COUNT(DISTINCT `column_name`) AS distinct_count FROM df;
-
-                             If the user asks for numerical statistics (AVG, MIN, MAX) on a categorical column, respond ONLY with the exact string 'Cannot process numerical statistics for categorical columns. Please specify a numerical column.'
-
-                             """
-                             ), MessagesPlaceholder("chat_history", optional=True), ("human", "{input}"), MessagesPlaceholder("agent_scratchpad"), ])
-
-                        agent = create_openai_tools_agent(llm, python_tools, prompt)
-                        agent_executor = AgentExecutor(agent=agent, tools=python_tools, verbose=True)
-
-                        response = agent_executor.invoke({"input": user_question, "chat_history": []})
-
-                        st.markdown("### ✨ Analysis Result")
-
-                        # Handle SQL vs Tool/Text outputs
-                        if isinstance(response, dict) and "output" in response:
-                            final_response_content = response["output"]
-                        elif hasattr(response, 'content'):
-                            final_response_content = response.content
-                        else:
-                            final_response_content = str(response)
-
-                        # Case 1: Outlier column missing
-                        if final_response_content == "Please specify a column to detect outliers in.":
-                            st.warning(f"⚠️ {final_response_content}")
-                        elif final_response_content == "Cannot process numerical statistics for categorical columns. Please specify a numerical column.":
-                            st.warning(f"⚠️ {final_response_content}")
-
-                        # Case 2: SQL query → run it automatically
-                        elif final_response_content.upper().startswith(
-                                ("SELECT", "PRAGMA", "CREATE", "INSERT", "UPDATE", "DELETE", "DROP", "ALTER")):
-                            generated_sql = final_response_content
-                            st.info("Generated SQL Query:")
-                            st.code(generated_sql, language="sql")
-
-                            with st.spinner("🚀 Running SQL query and fetching results..."):
-                                result, sql_error_message = run_pandasql_query(generated_sql, df)
-                                if sql_error_message:
-                                    st.error(f"❌ {sql_error_message}")
-                                elif result is not None:
-                                    st.success("✅ Done!")
-                                    st.dataframe(result)
-
-                        # Case 3: Direct tool/text response
-                        else:
-                            st.write(final_response_content)
-
+                        asyncio.run(answer_question(questions[0], df, st.empty()))
             else:
-                st.warning("⚠️ Please enter a question.")
+                # One question per line: send the ones needing the LLM as a concurrent batch
+                llm_questions = [question for question, answer in zip(questions, local_answers) if answer is None]
+                responses = iter([])
+                if llm_questions:
+                    with st.spinner(f"🧠 Generating {len(llm_questions)} responses..."):
+                        responses = iter(asyncio.run(make_agent_executor(df).abatch(
+                            [{"input": question, "chat_history": []} for question in llm_questions],
+                            config={"max_concurrency": MAX_CONCURRENT_QUESTIONS}, return_exceptions=True)))
+
+                st.markdown("### ✨ Analysis Results")
+                for question, local_answer in zip(questions, local_answers):
+                    with st.expander(question, expanded=True):
+                        if local_answer is not None:
+                            st.write(local_answer)
+                            continue
+                        response = next(responses)
+                        if isinstance(response, Exception):
+                            st.error(f"❌ Error answering the question: {response}")
+                        else:
+                            render_response(response, df, st.empty())
+    elif uploaded_file:
+        st.info("⬅️ Please select at least one column to load.")
     else:
         st.info("⬆️ Please upload an Excel file to get started.")
 
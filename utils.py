@@ -1,21 +1,112 @@
+import io
+import weakref
+from contextlib import contextmanager
+from functools import wraps
+
+import duckdb
+import numpy as np
 import pandas as pd
-from pandasql import sqldf
+import pyarrow as pa
+import streamlit as st
+
+# Parsed uploads kept in memory; evicted frames are freed along with their own memoised results
+DATA_CACHE_MAX_ENTRIES = 4
+DATA_CACHE_TTL = "1h"
+
+# DataFrames known to the memoised tools, by id(); entries disappear with the frame
+_frames_by_id = weakref.WeakValueDictionary()
+# Memoised results for each of those DataFrames, by id(); dropped when the frame is freed
+_results_by_id = {}
+
+
+def _read_excel(source, **kwargs):
+    """Reads an Excel file with the Rust-based calamine engine, falling back to openpyxl."""
+    try:
+        return pd.read_excel(source, engine="calamine", **kwargs)
+    except ImportError:
+        source.seek(0)
+        return pd.read_excel(source, engine="openpyxl", **kwargs)
 
+@st.cache_data(show_spinner=False, max_entries=DATA_CACHE_MAX_ENTRIES, ttl=DATA_CACHE_TTL)
+def load_columns(file_bytes, file_name):
+    """Reads only the header row of the first sheet of an Excel file, returning its column names."""
+    try:
+        header = _read_excel(io.BytesIO(file_bytes), sheet_name=0, nrows=0)
+        return header.columns.tolist(), None
+    except Exception as e:
+        return None, f"Error loading Excel file '{file_name}': {e}"
 
-def load_data(file_path):
-    """Loads data from an Excel file into a pandas DataFrame."""
+@st.cache_resource(show_spinner=False, max_entries=DATA_CACHE_MAX_ENTRIES, ttl=DATA_CACHE_TTL)
+def load_data(file_bytes, file_name, usecols=None):
+    """Loads the first sheet of an Excel file into a pandas DataFrame.
+
+    ``usecols`` optionally restricts loading to the given column positions; each
+    selection is a separate cache entry, counted against the same bound.
+    Results are cached on the file contents so Streamlit reruns skip parsing. The
+    same DataFrame object is returned each time (not a copy), so per-frame caches
+    keyed on its identity stay valid across reruns; callers must not mutate it.
+    Only the most recent uploads are kept, so evicted frames can be garbage
+    collected, which also clears their memoised tool results.
+    """
     try:
-        df = pd.read_excel(file_path)
+        # Arrow-backed columns are handed to DuckDB without conversion
+        df = _read_excel(io.BytesIO(file_bytes), sheet_name=0, usecols=list(usecols) if usecols else None,
+                         dtype_backend="pyarrow")
         if 'Unnamed: 0' in df.columns:
             df = df.drop(columns=['Unnamed: 0'])
         return df, None
-    except FileNotFoundError:
-        return None, f"Error: The file '{file_path}' was not found."
     except Exception as e:
-        return None, f"Error loading Excel file: {e}"
+        return None, f"Error loading Excel file '{file_name}': {e}"
+
+@contextmanager
+def _duckdb_connection(df):
+    """Yields a fresh in-memory DuckDB connection on which the DataFrame is registered as table 'df'.
 
-def get_dataframe_shape(df):
-    """Returns the number of rows and columns of the DataFrame."""
+    Nothing a query creates outlives it, so tables cannot leak between queries or sessions.
+    """
+    with duckdb.connect() as con:
+        # DuckDB scans the Arrow buffers directly, skipping pandas block introspection
+        con.register("df", _arrow_table(_frame_key(df)))
+        yield con
+
+def _frame_key(df):
+    """Returns the key under which results for this DataFrame are memoised."""
+    key = id(df)
+    if _frames_by_id.get(key) is not df:
+        _frames_by_id[key] = df
+        _results_by_id[key] = {}
+        # id() values are reused once a frame is freed, so drop its memoised results with it
+        weakref.finalize(df, _results_by_id.pop, key, None)
+    return key
+
+def _memoised_per_frame(func):
+    """Memoises ``func(df_key, *args)`` among the results of that DataFrame only."""
+    @wraps(func)
+    def wrapper(df_key, *args):
+        results = _results_by_id[df_key]
+        result_key = (func.__name__, *args)
+        if result_key not in results:
+            results[result_key] = func(df_key, *args)
+        return results[result_key]
+    return wrapper
+
+@_memoised_per_frame
+def _arrow_table(df_key):
+    """Returns the DataFrame as an Arrow table, converted once per DataFrame."""
+    return pa.Table.from_pandas(_frames_by_id[df_key], preserve_index=False)
+
+@_memoised_per_frame
+def _column_metadata(df_key):
+    """Returns the set of column names and their comma-separated listing, built once per DataFrame."""
+    columns = _frames_by_id[df_key].columns
+    return frozenset(columns), ", ".join(map(str, columns))
+
+def get_columns_str(df):
+    """Returns the DataFrame's column names as a comma-separated string."""
+    return _column_metadata(_frame_key(df))[1]
+
+def get_dataframe_shape(df, tool_input=None):
+    """Returns the number of rows and columns of the DataFrame. ``tool_input`` is ignored."""
     if df is not None:
         rows, cols = df.shape
         return f"The DataFrame has {rows} rows and {cols} columns."
@@ -25,39 +116,70 @@ def get_column_statistics(df, column_name):
     """Provides descriptive statistics for a specified column."""
     if df is None:
         return "DataFrame is not loaded."
-    if column_name not in df.columns:
+    if column_name not in _column_metadata(_frame_key(df))[0]:
         return f"Column '{column_name}' not found in the DataFrame."
-    
-    stats = df[column_name].describe()
+    return _column_statistics(_frame_key(df), column_name)
+
+@_memoised_per_frame
+def _column_statistics(df_key, column_name):
+    """Memoised body of get_column_statistics for a registered DataFrame."""
+    df = _frames_by_id[df_key]
+    column = df[column_name]
+    if pd.api.types.is_numeric_dtype(column) and not pd.api.types.is_bool_dtype(column):
+        # Single aggregation pass in DuckDB, laid out like Series.describe()
+        name = '"' + str(column_name).replace('"', '""') + '"'
+        with _duckdb_connection(df) as con:
+            count, mean, std, minimum, quartiles, maximum = con.execute(
+                f"SELECT count({name}), avg({name}), stddev_samp({name}), min({name}), "
+                f"quantile_cont({name}, [0.25, 0.5, 0.75]), max({name}) FROM df"
+            ).fetchone()
+        if quartiles is None:
+            quartiles = [None] * 3
+        stats = pd.Series([count, mean, std, minimum, *quartiles, maximum],
+                          index=["count", "mean", "std", "min", "25%", "50%", "75%", "max"],
+                          name=column_name, dtype="float64")
+    else:
+        stats = column.describe()
     return stats.to_string()
 
 def detect_outliers_iqr(df, column_name):
     """Detects outliers in a numerical column using the IQR method."""
     if df is None:
         return "DataFrame is not loaded."
-    if column_name not in df.columns:
+    if column_name not in _column_metadata(_frame_key(df))[0]:
         return f"Column '{column_name}' not found in the DataFrame."
+    return _outliers_iqr(_frame_key(df), column_name)
 
+@_memoised_per_frame
+def _outliers_iqr(df_key, column_name):
+    """Memoised body of detect_outliers_iqr for a registered DataFrame."""
+    df = _frames_by_id[df_key]
     if pd.api.types.is_numeric_dtype(df[column_name]):
-        Q1 = df[column_name].quantile(0.25)
-        Q3 = df[column_name].quantile(0.75)
-        IQR = Q3 - Q1
-        lower_bound = Q1 - 1.5 * IQR
-        upper_bound = Q3 + 1.5 * IQR
-        
-        outliers = df[(df[column_name] < lower_bound) | (df[column_name] > upper_bound)]
-        
-        if not outliers.empty:
-            return f" number of outliers detected in column '{column_name}' (IQR method):\n" + str(outliers.shape[0])
+        # Count on the raw values instead of building the subset of outlier rows
+        values = df[column_name].to_numpy(dtype=np.float64, na_value=np.nan)
+        if values.size == 0:
+            # np.nanquantile collapses to a scalar on an empty array
+            outlier_count = 0
+        else:
+            Q1, Q3 = np.nanquantile(values, [0.25, 0.75])
+            IQR = Q3 - Q1
+            lower_bound = Q1 - 1.5 * IQR
+            upper_bound = Q3 + 1.5 * IQR
+            outlier_count = int(np.count_nonzero((values < lower_bound) | (values > upper_bound)))
+
+        if outlier_count:
+            return f" number of outliers detected in column '{column_name}' (IQR method):\n" + str(outlier_count)
         else:
             return f"No outliers detected in column '{column_name}' (IQR method)."
     else:
         return f"Outlier detection (IQR method) is only applicable to numerical columns. '{column_name}' is not numerical."
 
 def run_pandasql_query(query, df):
-    """Runs a pandasql query on the DataFrame."""
+    """Runs a SQL query on the DataFrame with DuckDB, exposing it as table 'df'."""
     try:
-        result = sqldf(query, {"df": df})
+        # The LLM quotes identifiers with backticks; DuckDB expects double quotes.
+        with _duckdb_connection(df) as con:
+            result = con.execute(query.replace("`", '"')).fetch_df()
         return result, None
     except Exception as e:
         return None, f"Error running SQL query: {e}"